@@ -1,41 +1,129 @@
 import os
 import json
-import random
+import html
+import time
+import asyncio
+import logging
+import functools
 import datetime
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 from telegram import (
-    Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, ReplyKeyboardRemove
+    Update, ForceReply, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, ReplyKeyboardRemove
 )
+from telegram.constants import ParseMode
+from telegram.error import Forbidden, TelegramError
 from telegram.ext import (
-    ApplicationBuilder, CommandHandler, MessageHandler, CallbackQueryHandler,
+    AIORateLimiter, ApplicationBuilder, CommandHandler, MessageHandler, CallbackQueryHandler,
     ContextTypes, ConversationHandler, filters
 )
-import gspread
-from google.oauth2.service_account import Credentials
 
 # ===========================
 #   GOOGLE SHEETS SETUP
 # ===========================
-creds_json = os.getenv("GOOGLE_CREDS")
-creds_dict = json.loads(creds_json)
-creds = Credentials.from_service_account_info(
-    creds_dict,
-    scopes=["https://www.googleapis.com/auth/spreadsheets"]
-)
-gc = gspread.authorize(creds)
-SHEET = gc.open_by_key(os.getenv("SHEET_ID")).sheet1
+SHEET_ID = os.getenv("SHEET_ID")
+# Columnas que consultan las búsquedas: usuario, nombre, cédula, referido y
+# código. La fecha (columna F) solo se escribe, no hace falta descargarla.
+RANGO_HOJA = "A1:E"
+# (conexión, lectura) en segundos por petición: una llamada colgada no puede
+# retener _sheet_lock para siempre y frenar la sincronización.
+SHEETS_TIMEOUT = (10, 60)
+
+# El cliente autorizado se crea una sola vez; si una llamada falla solo se
+# vuelve a abrir la hoja, sin repetir el parseo de credenciales ni el OAuth.
+_gc = None
+_sheet = None
+
+def crear_cliente_sheets():
+    import gspread
+    from google.auth.transport.requests import AuthorizedSession
+    from google.oauth2.service_account import Credentials
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    creds_dict = json.loads(os.getenv("GOOGLE_CREDS"))
+    creds = Credentials.from_service_account_info(
+        creds_dict,
+        scopes=["https://www.googleapis.com/auth/spreadsheets"]
+    )
+    # Una sola sesión con conexiones reutilizables y reintentos con espera
+    # exponencial ante cuotas (429) y errores transitorios de Google. Los POST
+    # (append_rows) quedan fuera: tras un 5xx Google pudo haber escrito las
+    # filas y repetirlo al instante las duplicaría. El lote vuelve a la cola
+    # y sync_worker decide cuándo reintentarlo.
+    reintentos = Retry(
+        total=5, backoff_factor=1.5, status_forcelist=(429, 500, 502, 503),
+        respect_retry_after_header=True
+    )
+    session = AuthorizedSession(creds)
+    session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=1, max_retries=reintentos))
+    gc = gspread.Client(auth=creds, session=session)
+    gc.set_timeout(SHEETS_TIMEOUT)
+    return gc
+
+def obtener_hoja():
+    global _gc, _sheet
+    if _sheet is None:
+        if _gc is None:
+            _gc = crear_cliente_sheets()
+        _sheet = _gc.open_by_key(SHEET_ID).sheet1
+    return _sheet
+
+def llamar_hoja(metodo, *args, **kwargs):
+    global _sheet
+    try:
+        return getattr(obtener_hoja(), metodo)(*args, **kwargs)
+    except Exception:
+        _sheet = None
+        raise
+
+# Hilo propio para gspread: una llamada lenta a Google no ocupa el executor
+# por defecto del event loop. Basta uno (y una conexión en la sesión) porque
+# todas las llamadas pasan por _sheet_lock y nunca hay dos a la vez.
+SHEETS_POOL = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sheets")
+
+async def llamar_hoja_async(metodo, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(SHEETS_POOL, functools.partial(llamar_hoja, metodo, *args, **kwargs))
+
+logger = logging.getLogger(__name__)
 
 # ===========================
 #   VARIABLES
 # ===========================
 TOKEN = os.getenv("BOT_TOKEN")
-ADMIN_IDS = [int(x) for x in os.getenv("ADMIN_IDS").split(",")]
+# Con WEBHOOK_URL el bot recibe las actualizaciones por webhook en lugar de
+# long polling; BOT_API_URL apunta a un servidor local de la Bot API.
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+BOT_API_URL = os.getenv("BOT_API_URL")
+ADMIN_IDS = tuple(dict.fromkeys(int(x) for x in os.getenv("ADMIN_IDS").split(",") if x.strip()))
+# Con ADMIN_GROUP_ID el comprobante se envía una sola vez al grupo de admins
+# en lugar de un mensaje privado por cada uno. Con el modo privacidad de
+# Telegram (activo por defecto) el bot solo recibe en el grupo los comandos y
+# las respuestas a sus mensajes: por eso "Enviar mensaje" pide el texto con
+# ForceReply y el admin debe responder a ese aviso.
+ADMIN_GROUP_ID = os.getenv("ADMIN_GROUP_ID")
+DESTINOS_COMPROBANTE = (int(ADMIN_GROUP_ID),) if ADMIN_GROUP_ID else ADMIN_IDS
 FILE_ID_MONTOS = os.getenv("FILE_ID_MONTOS")
 FILE_ID_NX = os.getenv("FILE_ID_NX")
+REFRESCO_INTERVALO = 30  # segundos entre recargas completas de la hoja
+SYNC_ESPERA = 0.5  # ventana para juntar filas en un solo append_rows
+SYNC_INTERVAL = 5  # espera antes de reintentar una sincronización fallida
+MONTOS = range(200000, 501000, 50000)
+MAX_ENVIOS = 30  # límite de Telegram: ~30 mensajes/s por bot
+BLOQUEO_TTL = 3600  # segundos sin reintentar a un admin que bloqueó al bot
 
 (
     MONTO, CONFIRMAR_INVERSION, REFERIDO, CONFIRMAR_REGISTRO,
-    NOMBRE, CEDULA, ESPERAR_COMPROBANTE, ADMIN_BROADCAST
-) = range(8)
+    NOMBRE, CEDULA, ESPERAR_COMPROBANTE
+) = range(7)
+
+TEXTO_SIN_COMANDO = filters.TEXT & ~filters.COMMAND
+
+CAPTION_COMPROBANTE = (
+    "<b>Nuevo comprobante</b> de {nombre} (Cédula: {cedula}).\n"
+    "Monto: {monto}\nCódigo: {codigo}"
+)
 
 MAIN_MENU = ReplyKeyboardMarkup(
     [["Nueva inversión", "Mis referidos"],
@@ -44,38 +132,187 @@ MAIN_MENU = ReplyKeyboardMarkup(
     resize_keyboard=True
 )
 
+# Teclados fijos: se construyen una vez al cargar el módulo.
+TECLADO_MONTOS = InlineKeyboardMarkup(
+    [[InlineKeyboardButton(str(x), callback_data=f"monto_{x}")] for x in MONTOS]
+)
+TECLADO_CONFIRMAR = InlineKeyboardMarkup([
+    [InlineKeyboardButton("Sí ✅", callback_data="confirmar_si")],
+    [InlineKeyboardButton("No ❌", callback_data="confirmar_no")]
+])
+TECLADO_REFERIDO = InlineKeyboardMarkup([
+    [InlineKeyboardButton("Sí", callback_data="ref_si")],
+    [InlineKeyboardButton("No", callback_data="ref_no")]
+])
+TECLADO_REGISTRO = InlineKeyboardMarkup([
+    [InlineKeyboardButton("Sí ✅", callback_data="reg_si")],
+    [InlineKeyboardButton("No ❌", callback_data="reg_no")]
+])
+
 # ===========================
-#   FUNCIONES AUXILIARES
+#   ESTADO POR USUARIO
 # ===========================
-def generar_codigo():
-    return str(random.randint(1000, 9999))
+# Un objeto con __slots__ por conversación en lugar de varias claves sueltas
+# en user_data: ocupa bastante menos memoria con miles de usuarios.
+@dataclass(slots=True)
+class EstadoUsuario:
+    monto: int = 0
+    esperando_referido: bool = False
+    referido: str = "N/A"
+    nombre: str = ""
+    cedula: str = ""
+    codigo: str | None = None
+    msg_target: int | None = None
+    msg_prompt: tuple[int, int] | None = None  # (chat, mensaje) del aviso ForceReply
+
+def estado_usuario(context):
+    estado = context.user_data.get("estado")
+    if estado is None:
+        estado = context.user_data["estado"] = EstadoUsuario()
+    return estado
 
+# ===========================
+#   FUNCIONES AUXILIARES
+# ===========================
 def calcular_pago(monto):
     return int(monto * 1.9)
 
-def fecha_pago():
-    return (datetime.date.today() + datetime.timedelta(days=10)).strftime("%d/%m/%Y")
+# Solo hay siete montos posibles (y sus pagos): se formatean una vez al cargar.
+_MONTOS_FMT = {n: f"{n:,}" for m in MONTOS for n in (m, calcular_pago(m))}
+
+def formatear_monto(n):
+    texto = _MONTOS_FMT.get(n)
+    return texto if texto is not None else f"{n:,}"
+
+# La fecha de pago solo cambia una vez al día: se formatea una vez por fecha.
+@functools.lru_cache(maxsize=4)
+def _fecha_pago(hoy):
+    return (hoy + datetime.timedelta(days=10)).strftime("%d/%m/%Y")
+
+def fecha_pago(hoy=None):
+    return _fecha_pago(hoy or datetime.date.today())
+
+# Copia en memoria de la hoja: las lecturas se sirven siempre desde aquí,
+# refresco_worker la renueva cada REFRESCO_INTERVALO segundos y las
+# escrituras la parchean en lugar de invalidarla.
+# "nombres" indexa código de usuario -> nombre y "siguiente_codigo" nunca
+# retrocede, así los códigos nuevos son únicos sin buscar colisiones.
+# Las filas nuevas quedan en _pendientes hasta que sync_worker las sube.
+# _sheet_lock solo ordena las llamadas a Google (recarga y append_rows) entre
+# sí; los handlers no lo toman una vez cargada la copia.
+_sheet_cache = {"headers": [], "filas": None, "nombres": {}, "siguiente_codigo": 1001}
+_sheet_lock = asyncio.Lock()
+_pendientes = []
+_hay_pendientes = asyncio.Event()
+
+def _indexar_fila(fila):
+    if len(fila) > 4 and fila[1] != "INVERSION":
+        _sheet_cache["nombres"][fila[4]] = fila[1]
+        if fila[4].isdigit():
+            _sheet_cache["siguiente_codigo"] = max(_sheet_cache["siguiente_codigo"], int(fila[4]) + 1)
+
+async def cargar_hoja(forzar=False):
+    if not forzar and _sheet_cache["filas"] is not None:
+        return _sheet_cache
+    async with _sheet_lock:
+        if forzar or _sheet_cache["filas"] is None:
+            valores = await llamar_hoja_async("get_values", RANGO_HOJA)
+            # Sin awaits desde aquí: la copia se reemplaza de una sola vez.
+            _sheet_cache["headers"] = valores[0] if valores else []
+            _sheet_cache["filas"] = valores[1:] + [[str(v) for v in f] for f in _pendientes]
+            _sheet_cache["nombres"] = {}
+            for fila in _sheet_cache["filas"]:
+                _indexar_fila(fila)
+    return _sheet_cache
+
+def agregar_fila(fila):
+    _pendientes.append(fila)
+    _hay_pendientes.set()
+    if _sheet_cache["filas"] is not None:
+        fila = [str(v) for v in fila]
+        _sheet_cache["filas"].append(fila)
+        _indexar_fila(fila)
+
+_envios = asyncio.Semaphore(MAX_ENVIOS)
+
+async def enviar_limitado(metodo, **kwargs):
+    async with _envios:
+        return await metodo(**kwargs)
+
+@functools.lru_cache(maxsize=2048)
+def teclado_admin(user_id):
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("Aceptar ✅", callback_data=f"aceptar_{user_id}")],
+        [InlineKeyboardButton("Rechazar ❌", callback_data=f"rechazar_{user_id}")],
+        [InlineKeyboardButton("Enviar mensaje ✉️", callback_data=f"msg_{user_id}")]
+    ])
+
+# Admins que bloquearon al bot o nunca lo iniciaron (chat privado -> momento
+# del Forbidden): se saltan durante BLOQUEO_TTL segundos. El grupo de admins
+# nunca se salta: si falla, el comprobante se envía a cada admin.
+_destinos_bloqueados = {}
+
+async def enviar_comprobante(bot, destinos, file_id, caption, markup):
+    send_photo = bot.send_photo
+    resultados = await asyncio.gather(*(
+        enviar_limitado(send_photo, chat_id=admin_id, photo=file_id,
+                        caption=caption, parse_mode=ParseMode.HTML, reply_markup=markup)
+        for admin_id in destinos
+    ), return_exceptions=True)
+    enviados = 0
+    for admin_id, resultado in zip(destinos, resultados):
+        if isinstance(resultado, Exception):
+            logger.error("No se pudo enviar el comprobante a %s: %s", admin_id, resultado)
+            if isinstance(resultado, Forbidden) and admin_id in ADMIN_IDS:
+                _destinos_bloqueados[admin_id] = time.time()
+        else:
+            enviados += 1
+    return enviados
+
+async def notificar_admins(bot, file_id, caption, markup):
+    if ADMIN_GROUP_ID:
+        if await enviar_comprobante(bot, DESTINOS_COMPROBANTE, file_id, caption, markup):
+            return
+        logger.error("El grupo de admins no recibió el comprobante; se envía a cada admin")
+    ahora = time.time()
+    destinos = [d for d in ADMIN_IDS if ahora - _destinos_bloqueados.get(d, 0) >= BLOQUEO_TTL]
+    if not destinos:
+        logger.error("Todos los admins bloquearon al bot; se reintenta con todos")
+        destinos = ADMIN_IDS
+    if not await enviar_comprobante(bot, destinos, file_id, caption, markup):
+        logger.error("Ningún admin recibió el comprobante")
 
 def registrar_usuario(user_id, nombre, cedula, referido, codigo):
-    SHEET.append_row([str(user_id), nombre, cedula, referido, codigo, str(datetime.date.today())])
+    agregar_fila([str(user_id), nombre, cedula, referido, codigo, str(datetime.date.today())])
 
 def registrar_inversion(user_id, monto, codigo):
-    SHEET.append_row([str(user_id), "INVERSION", monto, codigo, str(datetime.date.today()), fecha_pago()])
+    hoy = datetime.date.today()
+    agregar_fila([str(user_id), "INVERSION", monto, codigo, hoy.isoformat(), fecha_pago(hoy)])
+
+async def generar_codigo():
+    cache = await cargar_hoja()
+    codigo = cache["siguiente_codigo"]
+    cache["siguiente_codigo"] += 1
+    return str(codigo)
 
-def obtener_referidos(codigo):
-    data = SHEET.get_all_records()
-    return [row for row in data if row.get("Referido") == codigo]
+async def nombre_por_codigo(codigo):
+    cache = await cargar_hoja()
+    return cache["nombres"].get(codigo)
+
+async def obtener_referidos(codigo):
+    cache = await cargar_hoja()
+    headers = cache["headers"]
+    return [dict(zip(headers, fila)) for fila in cache["filas"]
+            if len(fila) > 3 and fila[1] != "INVERSION" and fila[3] == codigo]
 
 # ===========================
 #   HANDLERS
 # ===========================
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    keyboard = [[InlineKeyboardButton(str(x), callback_data=f"monto_{x}")]
-                for x in range(200000, 501000, 50000)]
     await update.message.reply_photo(
         FILE_ID_MONTOS,
         caption="Bienvenido 🙌\nSelecciona el monto de inversión:",
-        reply_markup=InlineKeyboardMarkup(keyboard)
+        reply_markup=TECLADO_MONTOS
     )
     return MONTO
 
@@ -83,15 +320,12 @@ async def elegir_monto(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     monto = int(query.data.split("_")[1])
-    context.user_data["monto"] = monto
+    estado_usuario(context).monto = monto
     pago = calcular_pago(monto)
     await query.edit_message_text(
-        f"Elegiste invertir {monto:,}.\n"
-        f"Recibirás {pago:,} en {fecha_pago()}.\n¿Confirmas?",
-        reply_markup=InlineKeyboardMarkup([
-            [InlineKeyboardButton("Sí ✅", callback_data="confirmar_si")],
-            [InlineKeyboardButton("No ❌", callback_data="confirmar_no")]
-        ])
+        f"Elegiste invertir {formatear_monto(monto)}.\n"
+        f"Recibirás {formatear_monto(pago)} en {fecha_pago()}.\n¿Confirmas?",
+        reply_markup=TECLADO_CONFIRMAR
     )
     return CONFIRMAR_INVERSION
 
@@ -104,10 +338,7 @@ async def confirmar_inversion(update: Update, context: ContextTypes.DEFAULT_TYPE
 
     await query.edit_message_text(
         "¿Vienes referido por alguien?",
-        reply_markup=InlineKeyboardMarkup([
-            [InlineKeyboardButton("Sí", callback_data="ref_si")],
-            [InlineKeyboardButton("No", callback_data="ref_no")]
-        ])
+        reply_markup=TECLADO_REFERIDO
     )
     return REFERIDO
 
@@ -116,25 +347,22 @@ async def referido(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await query.answer()
     if query.data == "ref_si":
         await query.edit_message_text("Ingresa el código de referido:")
-        context.user_data["esperando_referido"] = True
+        estado_usuario(context).esperando_referido = True
         return REFERIDO
     else:
-        await query.edit_message_text("¿Deseas registrarte?",
-                                      reply_markup=InlineKeyboardMarkup([
-                                          [InlineKeyboardButton("Sí ✅", callback_data="reg_si")],
-                                          [InlineKeyboardButton("No ❌", callback_data="reg_no")]
-                                      ]))
+        await query.edit_message_text("¿Deseas registrarte?", reply_markup=TECLADO_REGISTRO)
         return CONFIRMAR_REGISTRO
 
 async def procesar_referido(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if context.user_data.get("esperando_referido"):
+    estado = estado_usuario(context)
+    if estado.esperando_referido:
         codigo = update.message.text.strip()
-        context.user_data["referido"] = codigo
-        await update.message.reply_text("¿Deseas registrarte?",
-                                        reply_markup=InlineKeyboardMarkup([
-                                            [InlineKeyboardButton("Sí ✅", callback_data="reg_si")],
-                                            [InlineKeyboardButton("No ❌", callback_data="reg_no")]
-                                        ]))
+        estado.referido = codigo
+        # Solo se confirma que el código existe: los códigos son consecutivos y
+        # mostrar el nombre permitiría listar a todos los inversionistas.
+        valido = await nombre_por_codigo(codigo) is not None
+        texto = "Código de referido válido ✅\n¿Deseas registrarte?" if valido else "¿Deseas registrarte?"
+        await update.message.reply_text(texto, reply_markup=TECLADO_REGISTRO)
         return CONFIRMAR_REGISTRO
 
 async def confirmar_registro(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -148,19 +376,20 @@ async def confirmar_registro(update: Update, context: ContextTypes.DEFAULT_TYPE)
     return NOMBRE
 
 async def guardar_nombre(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    context.user_data["nombre"] = update.message.text.strip()
+    estado_usuario(context).nombre = update.message.text.strip()
     await update.message.reply_text("Ingresa tu número de cédula:")
     return CEDULA
 
 async def guardar_cedula(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    context.user_data["cedula"] = update.message.text.strip()
-    codigo = generar_codigo()
-    context.user_data["codigo"] = codigo
+    estado = estado_usuario(context)
+    estado.cedula = update.message.text.strip()
+    codigo = await generar_codigo()
+    estado.codigo = codigo
     registrar_usuario(
         update.effective_user.id,
-        context.user_data["nombre"],
-        context.user_data["cedula"],
-        context.user_data.get("referido", "N/A"),
+        estado.nombre,
+        estado.cedula,
+        estado.referido,
         codigo
     )
 
@@ -173,62 +402,168 @@ async def guardar_cedula(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return ESPERAR_COMPROBANTE
 
 async def recibir_comprobante(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if update.message.photo:
-        file_id = update.message.photo[-1].file_id
-        monto = context.user_data.get("monto", 0)
-        codigo = context.user_data.get("codigo")
-        registrar_inversion(update.effective_user.id, monto, codigo)
-
-        for admin_id in ADMIN_IDS:
-            await context.bot.send_photo(
-                chat_id=admin_id,
-                photo=file_id,
-                caption=f"Nuevo comprobante de {context.user_data['nombre']} (Cédula: {context.user_data['cedula']}).\n"
-                        f"Monto: {monto:,}\nCódigo: {codigo}",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("Aceptar ✅", callback_data=f"aceptar_{update.effective_user.id}")],
-                    [InlineKeyboardButton("Rechazar ❌", callback_data=f"rechazar_{update.effective_user.id}")],
-                    [InlineKeyboardButton("Enviar mensaje ✉️", callback_data=f"msg_{update.effective_user.id}")]
-                ])
-            )
-
-        await update.message.reply_text("📌 Tu comprobante fue enviado a validación.\n"
-                                        "Tendrá respuesta en 5-10 minutos.",
-                                        reply_markup=MAIN_MENU)
+    msg = update.message
+    fotos = msg.photo
+    if fotos:
+        estado = estado_usuario(context)
+        monto = estado.monto
+        user_id = update.effective_user.id
+        file_id = fotos[-1].file_id
+        codigo = estado.codigo
+        registrar_inversion(user_id, monto, codigo)
+
+        caption = CAPTION_COMPROBANTE.format(
+            nombre=html.escape(estado.nombre),
+            cedula=html.escape(estado.cedula),
+            monto=formatear_monto(monto),
+            codigo=codigo
+        )
+        markup = teclado_admin(user_id)
+        await msg.reply_text("📌 Tu comprobante fue enviado a validación.\n"
+                             "Tendrá respuesta en 5-10 minutos.",
+                             reply_markup=MAIN_MENU)
+        context.application.create_task(notificar_admins(context.bot, file_id, caption, markup))
         return ConversationHandler.END
 
 # ===========================
 #   ADMIN FUNCIONES
 # ===========================
+# El caption solo confirma la decisión si el usuario recibió el aviso; si no,
+# queda marcado para que el admin sepa que debe contactarlo por otra vía.
+async def responder_comprobante(context, query, user_id, texto, caption):
+    try:
+        await context.bot.send_message(chat_id=user_id, text=texto, reply_markup=MAIN_MENU)
+    except TelegramError as e:
+        logger.error("No se pudo avisar al usuario %s: %s", user_id, e)
+        caption = f"{caption}\n⚠️ No se pudo avisar al usuario."
+    await query.edit_message_caption(caption=caption)
+
 async def admin_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
+    if query.from_user.id not in ADMIN_IDS:
+        await query.answer("No autorizado.")
+        return
     await query.answer()
     action, user_id = query.data.split("_")
     user_id = int(user_id)
 
     if action == "aceptar":
-        await context.bot.send_message(chat_id=user_id, text="✅ Tu comprobante fue validado. Gracias por confiar.", reply_markup=MAIN_MENU)
-        await query.edit_message_caption(caption="Comprobante validado ✅")
+        await responder_comprobante(context, query, user_id,
+                                    "✅ Tu comprobante fue validado. Gracias por confiar.",
+                                    "Comprobante validado ✅")
     elif action == "rechazar":
-        await context.bot.send_message(chat_id=user_id, text="❌ Tu comprobante fue rechazado. Vuelve a intentarlo.", reply_markup=MAIN_MENU)
-        await query.edit_message_caption(caption="Comprobante rechazado ❌")
+        await responder_comprobante(context, query, user_id,
+                                    "❌ Tu comprobante fue rechazado. Vuelve a intentarlo.",
+                                    "Comprobante rechazado ❌")
     elif action == "msg":
-        context.user_data["msg_target"] = user_id
-        await query.message.reply_text("✉️ Escribe el mensaje que deseas enviar al usuario:")
-        return ADMIN_BROADCAST
+        estado = estado_usuario(context)
+        # La mención más selective=True abre la respuesta solo para este admin.
+        aviso = await query.message.reply_text(
+            f"✉️ {query.from_user.mention_html()}, escribe el mensaje que deseas enviar al usuario:",
+            parse_mode=ParseMode.HTML,
+            reply_markup=ForceReply(selective=True)
+        )
+        estado.msg_target = user_id
+        estado.msg_prompt = (aviso.chat_id, aviso.message_id)
 
 async def admin_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    target = context.user_data.get("msg_target")
-    if target:
-        await context.bot.send_message(chat_id=target, text=f"📩 Mensaje del administrador:\n\n{update.message.text}")
-        await update.message.reply_text("✅ Mensaje enviado al usuario.")
-    return ConversationHandler.END
+    # Solo cuenta la respuesta al aviso de "Enviar mensaje": otras respuestas
+    # del admin (a un comprobante, a la conversación de inversión) se ignoran.
+    estado = estado_usuario(context)
+    respuesta = update.message.reply_to_message
+    if estado.msg_target is None or (respuesta.chat_id, respuesta.message_id) != estado.msg_prompt:
+        return
+    target, estado.msg_target, estado.msg_prompt = estado.msg_target, None, None
+    await context.bot.send_message(chat_id=target, text=f"📩 Mensaje del administrador:\n\n{update.message.text}")
+    await update.message.reply_text("✅ Mensaje enviado al usuario.")
+
+# ===========================
+#   SINCRONIZACIÓN CON SHEETS
+# ===========================
+async def sincronizar_hoja():
+    async with _sheet_lock:
+        if not _pendientes:
+            return
+        lote = _pendientes[:]
+        del _pendientes[:len(lote)]
+        subida = asyncio.ensure_future(llamar_hoja_async(
+            "append_rows", lote, value_input_option="RAW", insert_data_option="INSERT_ROWS"
+        ))
+        try:
+            await asyncio.shield(subida)
+        except asyncio.CancelledError:
+            # El hilo de gspread no se puede detener y Google igual recibe el
+            # lote: se espera su respuesta y solo vuelve a la cola si falló.
+            try:
+                await subida
+            except Exception:
+                _pendientes[:0] = lote
+            raise
+        except Exception:
+            _pendientes[:0] = lote
+            raise
+
+async def sync_worker():
+    while True:
+        await _hay_pendientes.wait()
+        await asyncio.sleep(SYNC_ESPERA)
+        _hay_pendientes.clear()
+        try:
+            await sincronizar_hoja()
+        except Exception:
+            logger.exception("No se pudo sincronizar con Google Sheets")
+            _hay_pendientes.set()
+            await asyncio.sleep(SYNC_INTERVAL)
+
+# Trae los cambios que se hagan en la hoja por fuera del bot. Corre en segundo
+# plano: mientras descarga, los handlers siguen leyendo la copia anterior.
+async def refresco_worker():
+    while True:
+        await asyncio.sleep(REFRESCO_INTERVALO)
+        try:
+            await cargar_hoja(forzar=True)
+        except Exception:
+            logger.exception("No se pudo refrescar la copia de Google Sheets")
+
+async def al_iniciar(app):
+    await cargar_hoja()
+    app.bot_data["sync_task"] = asyncio.create_task(sync_worker())
+    app.bot_data["refresco_task"] = asyncio.create_task(refresco_worker())
+
+async def al_cerrar(app):
+    # Si al_iniciar falló (Sheets caído al arrancar) las tareas no existen.
+    tareas = [t for t in (app.bot_data.get("refresco_task"), app.bot_data.get("sync_task")) if t]
+    for tarea in tareas:
+        tarea.cancel()
+    # Se espera a que terminen antes del vaciado final: un lote a medio subir
+    # termina de subirse o, si falla, vuelve a _pendientes.
+    await asyncio.gather(*tareas, return_exceptions=True)
+    try:
+        await sincronizar_hoja()
+    except Exception:
+        # La memoria era la única copia: se dejan las filas en el log para
+        # poder cargarlas a mano.
+        logger.exception("No se pudieron subir %d filas al cerrar: %s", len(_pendientes), _pendientes)
 
 # ===========================
 #   MAIN
 # ===========================
 def main():
-    app = ApplicationBuilder().token(TOKEN).build()
+    logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
+    # Conexiones suficientes para los envíos simultáneos que permite _envios
+    # más las respuestas normales de los handlers.
+    builder = (
+        ApplicationBuilder().token(TOKEN)
+        .connection_pool_size(MAX_ENVIOS * 2)
+        .pool_timeout(30).connect_timeout(15).read_timeout(30)
+        # Respeta los límites de Telegram (30 msg/s global, 20 msg/min por grupo)
+        # y reintenta una vez tras un RetryAfter.
+        .rate_limiter(AIORateLimiter(max_retries=1))
+        .post_init(al_iniciar).post_shutdown(al_cerrar)
+    )
+    if BOT_API_URL:
+        builder = builder.base_url(BOT_API_URL)
+    app = builder.build()
 
     conv = ConversationHandler(
         entry_points=[CommandHandler("start", start)],
@@ -237,20 +572,33 @@ def main():
             CONFIRMAR_INVERSION: [CallbackQueryHandler(confirmar_inversion, pattern="^confirmar_")],
             REFERIDO: [
                 CallbackQueryHandler(referido, pattern="^ref_"),
-                MessageHandler(filters.TEXT & ~filters.COMMAND, procesar_referido)
+                MessageHandler(TEXTO_SIN_COMANDO, procesar_referido)
             ],
             CONFIRMAR_REGISTRO: [CallbackQueryHandler(confirmar_registro, pattern="^reg_")],
-            NOMBRE: [MessageHandler(filters.TEXT & ~filters.COMMAND, guardar_nombre)],
-            CEDULA: [MessageHandler(filters.TEXT & ~filters.COMMAND, guardar_cedula)],
+            NOMBRE: [MessageHandler(TEXTO_SIN_COMANDO, guardar_nombre)],
+            CEDULA: [MessageHandler(TEXTO_SIN_COMANDO, guardar_cedula)],
             ESPERAR_COMPROBANTE: [MessageHandler(filters.PHOTO, recibir_comprobante)],
-            ADMIN_BROADCAST: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_broadcast)],
         },
         fallbacks=[]
     )
 
     app.add_handler(conv)
-    app.add_handler(CallbackQueryHandler(admin_callback, pattern="^(aceptar|rechazar|msg)_"))
-    app.run_polling()
+    app.add_handler(CallbackQueryHandler(admin_callback, pattern="^(aceptar|rechazar|msg)_", block=False))
+    # En un grupo aparte para no competir con la conversación de inversión.
+    app.add_handler(MessageHandler(TEXTO_SIN_COMANDO & filters.REPLY & filters.User(user_id=ADMIN_IDS),
+                                   admin_broadcast, block=False),
+                    group=1)
+    actualizaciones = [Update.MESSAGE, Update.CALLBACK_QUERY]
+    if WEBHOOK_URL:
+        app.run_webhook(
+            listen="0.0.0.0",
+            port=int(os.getenv("PORT", "8443")),
+            url_path=TOKEN,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{TOKEN}",
+            allowed_updates=actualizaciones
+        )
+    else:
+        app.run_polling(timeout=30, allowed_updates=actualizaciones)
 
 if __name__ == "__main__":
     main()